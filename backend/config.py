@@ -88,4 +88,25 @@ GCP_ZONE = "europe-west1-b"
 DEFAULT_OUTPUT_DIR = "output"
 DEFAULT_TERRAFORM_DIR = os.path.join(DEFAULT_OUTPUT_DIR, "terraform")
 DEFAULT_GRAPH_FILE = os.path.join(DEFAULT_OUTPUT_DIR, "network_graph.pdf")
-DEFAULT_ANALYSIS_FILE = os.path.join(DEFAULT_OUTPUT_DIR, "network_analysis.json")
\ No newline at end of file
+DEFAULT_ANALYSIS_FILE = os.path.join(DEFAULT_OUTPUT_DIR, "network_analysis.json")
+
+# Dimensione minima (in byte) oltre la quale i file PCAP vengono analizzati in parallelo
+PCAP_PARALLEL_MIN_SIZE = 64 * 1024 * 1024
+# Byte minimi assegnati a ciascun processo: il numero di processi cresce con il file
+PCAP_PARALLEL_CHUNK_MIN = 32 * 1024 * 1024
+# Numero massimo di processi per l'analisi parallela (almeno 1)
+try:
+    PCAP_PARALLEL_MAX_WORKERS = max(1, int(os.environ.get("AUTONETGEN_PCAP_MAX_WORKERS", "8")))
+except ValueError:
+    logger.warning("AUTONETGEN_PCAP_MAX_WORKERS non è un intero valido: uso il valore predefinito 8")
+    PCAP_PARALLEL_MAX_WORKERS = 8
+
+# Soglie oltre le quali il grafo Graphviz viene reso in forma semplificata
+GRAPH_MAX_EDGES = 500
+GRAPH_PORT_LABELS_MAX_NODES = 200
+GRAPH_EDGE_LABELS_MAX_EDGES = 300
+
+# Directory della cache dei grafi renderizzati (disabilitata se non impostata)
+GRAPH_CACHE_DIR = os.environ.get("AUTONETGEN_CACHE_DIR")
+# Numero massimo di file mantenuti in cache (i meno recenti vengono rimossi)
+GRAPH_CACHE_MAX_FILES = 64
\ No newline at end of file
@@ -30,6 +30,25 @@ class NetworkData:
     def add_protocol(self, proto):
         """Aggiunge un conteggio del protocollo utilizzato"""
         self.protocols[proto] += 1
+
+    def add_hosts(self, ips):
+        """Aggiunge un insieme di host alla lista degli host"""
+        self.hosts.update(ips)
+
+    def add_connections(self, counts):
+        """Aggiunge i conteggi delle connessioni indicizzati per (src_ip, dst_ip)"""
+        for key, count in counts.items():
+            self.connections[key] += count
+
+    def add_ports(self, port_infos):
+        """Aggiunge più informazioni (ip, porta, direzione, protocollo) sulle porte"""
+        for ip, port, direction, proto in port_infos:
+            self.host_ports[ip].add((port, direction, proto))
+
+    def add_protocols(self, counts):
+        """Aggiunge i conteggi dei protocolli indicizzati per nome"""
+        for proto, count in counts.items():
+            self.protocols[proto] += count
         
     def from_dict(self, data_dict):
         """Popola i dati da un dizionario"""
@@ -3,15 +3,53 @@
 GraphvizGenerator - Generatore di grafi di rete con Graphviz
 """
 
+import functools
+import hashlib
+import heapq
+import io
 import os
-import matplotlib.pyplot as plt
-import graphviz
+import shutil
+import subprocess
+import tempfile
 import networkx as nx
 from collections import defaultdict
-from config import logger, ROLE_COLORS, ROLE_SHAPES
+from config import (logger, ROLE_COLORS, ROLE_SHAPES, GRAPH_MAX_EDGES,
+                    GRAPH_PORT_LABELS_MAX_NODES, GRAPH_EDGE_LABELS_MAX_EDGES,
+                    GRAPH_CACHE_DIR, GRAPH_CACHE_MAX_FILES)
 from output_generators.base_generator import OutputGenerator
 
 
+def _quote(value):
+    """Restituisce un ID DOT tra virgolette, con le virgolette interne escapate"""
+    return '"' + str(value).replace('"', '\\"') + '"'
+
+
+def _format_attrs(attrs):
+    """Serializza un dizionario di attributi nella lista DOT [k="v" ...]"""
+    return '[' + ' '.join(f'{key}={_quote(value)}' for key, value in attrs.items()) + ']'
+
+
+@functools.lru_cache(maxsize=4096)
+def _edge_attrs(protocols, weight, show_label):
+    """
+    Restituisce la lista di attributi DOT di un arco
+
+    Molti archi condividono gli stessi protocolli e lo stesso peso, quindi la
+    formattazione viene memorizzata per (protocolli, peso, etichetta visibile).
+    """
+    penwidth = str(0.5 + min(5, weight / 10))
+    if not show_label:
+        return _format_attrs({'penwidth': penwidth})
+
+    label = ", ".join(protocols[:3])
+    if len(protocols) > 3:
+        label += f", +{len(protocols) - 3}"
+    if weight > 1:
+        label += f" ({weight} conn.)"
+
+    return _format_attrs({'label': label, 'penwidth': penwidth})
+
+
 class GraphvizGenerator(OutputGenerator):
     """Generatore di output per i grafi di rete con Graphviz"""
 
@@ -23,56 +61,138 @@ class GraphvizGenerator(OutputGenerator):
 
         logger.info("Generazione del grafo di rete con Graphviz")
 
-        dot = self._init_graphviz()
+        # Il sorgente DOT viene costruito direttamente come lista di righe; nodi, archi,
+        # porte e protocolli sono ordinati perché il sorgente (e la chiave della cache)
+        # non dipenda dall'ordine di iterazione dei set
+        lines = self._init_graphviz()
+        profile = self._get_degrade_profile(graph)
+        edges = self._select_edges(graph, profile)
+        nodes_data = self._select_nodes(graph, edges, profile)
 
-        self._add_subnet_clusters(dot, graph)
-        self._add_unknown_subnet_nodes(dot, graph)
-        self._add_edges(dot, graph)
-        self._add_legend(dot, graph)
+        subnets, used_roles = self._add_subnet_clusters(lines, nodes_data, profile)
+        self._add_unknown_subnet_nodes(lines, subnets.get('UNKNOWN', []), profile)
+        self._add_edges(lines, edges, profile)
+        self._add_legend(lines, used_roles)
+        lines.append('}')
 
-        return self._render_output(dot, output_path)
+        return self._render_output('\n'.join(lines), output_path, graph)
 
     def _init_graphviz(self):
-        dot = graphviz.Digraph(
-            comment='Network Traffic Analysis',
-            format='pdf',
-            engine='dot',
-            strict=True
-        )
-        dot.attr(rankdir='LR', size='11,8', ratio='fill', fontname='Arial',
-                 label='Network Traffic Analysis', labelloc='t', fontsize='18', bgcolor='white')
-        dot.attr('node', fontname='Arial', fontsize='10')
-        dot.attr('edge', fontname='Arial', fontsize='8', arrowsize='0.5')
-        return dot
+        return [
+            '// Network Traffic Analysis',
+            'strict digraph {',
+            '\tgraph ' + _format_attrs({
+                'rankdir': 'LR', 'size': '11,8', 'ratio': 'fill', 'fontname': 'Arial',
+                'label': 'Network Traffic Analysis', 'labelloc': 't', 'fontsize': '18',
+                'bgcolor': 'white'
+            }),
+            '\tnode ' + _format_attrs({'fontname': 'Arial', 'fontsize': '10'}),
+            '\tedge ' + _format_attrs({'fontname': 'Arial', 'fontsize': '8', 'arrowsize': '0.5'}),
+        ]
+
+    def _get_degrade_profile(self, graph):
+        """
+        Determina quanto dettaglio rendere in base alle dimensioni del grafo
+
+        Args:
+            graph (nx.DiGraph): Grafo della rete
 
-    def _add_subnet_clusters(self, dot, graph):
+        Returns:
+            dict: max_edges, show_ports e show_edge_labels
+        """
+        num_nodes = graph.number_of_nodes()
+        num_edges = graph.number_of_edges()
+        profile = {
+            'max_edges': GRAPH_MAX_EDGES,
+            'show_ports': num_nodes < GRAPH_PORT_LABELS_MAX_NODES,
+            'show_edge_labels': num_edges < GRAPH_EDGE_LABELS_MAX_EDGES
+        }
+        if num_edges > GRAPH_MAX_EDGES or not profile['show_ports'] or not profile['show_edge_labels']:
+            logger.info(f"Grafo di grandi dimensioni ({num_nodes} nodi, {num_edges} archi): "
+                        f"rendering semplificato")
+        return profile
+
+    def _select_edges(self, graph, profile):
+        """
+        Seleziona gli archi da rendere, ordinati per nodo sorgente e destinazione
+
+        Args:
+            graph (nx.DiGraph): Grafo della rete
+            profile (dict): Profilo di degradazione
+
+        Returns:
+            list: Archi (sorgente, destinazione, attributi) da rendere
+        """
+        edges = graph.edges(data=True)
+        # Oltre la soglia si rendono solo gli archi con più connessioni; a parità di peso
+        # decide il nome dei nodi, così la selezione non dipende dall'ordine di iterazione
+        if graph.number_of_edges() > profile['max_edges']:
+            edges = heapq.nsmallest(profile['max_edges'], edges,
+                                    key=lambda edge: (-edge[2].get('weight', 1),
+                                                      str(edge[0]), str(edge[1])))
+        # Vengono ordinati solo gli archi rimasti (al più max_edges)
+        return sorted(edges, key=lambda edge: (str(edge[0]), str(edge[1])))
+
+    def _select_nodes(self, graph, edges, profile):
+        """
+        Seleziona i nodi da rendere, ordinati per nome
+
+        Se gli archi sono stati limitati si rendono solo i nodi collegati a un arco
+        selezionato, così anche il numero di nodi resta limitato.
+
+        Args:
+            graph (nx.DiGraph): Grafo della rete
+            edges (list): Archi selezionati da _select_edges
+            profile (dict): Profilo di degradazione
+
+        Returns:
+            list: Coppie (nodo, attributi) da rendere
+        """
+        nodes_data = graph.nodes(data=True)
+        if graph.number_of_edges() > profile['max_edges']:
+            kept = {node for src, dst, _ in edges for node in (src, dst)}
+            nodes_data = [(node, attrs) for node, attrs in nodes_data if node in kept]
+            logger.info(f"Omessi {graph.number_of_nodes() - len(nodes_data)} nodi "
+                        f"non collegati agli archi visualizzati")
+        return sorted(nodes_data, key=lambda item: str(item[0]))
+
+    def _add_subnet_clusters(self, lines, nodes_data, profile):
         subnets = defaultdict(list)
-        for node in graph.nodes():
-            subnet = graph.nodes[node].get('subnet', 'UNKNOWN')
-            subnets[subnet].append(node)
+        used_roles = set()
+        for node, attrs in nodes_data:
+            subnets[attrs.get('subnet', 'UNKNOWN')].append((node, attrs))
+            used_roles.add(attrs.get('role', 'UNKNOWN'))
 
         for i, (subnet, nodes) in enumerate(subnets.items()):
             if subnet == 'UNKNOWN':
                 continue
-            with dot.subgraph(name=f'cluster_{i}') as c:
-                c.attr(label=f'Subnet: {subnet}', style='filled',
-                       color='lightgrey', fontname='Arial', fontsize='10')
-                for node in nodes:
-                    c.node(node, **self._get_node_attrs(graph, node))
-
-    def _add_unknown_subnet_nodes(self, dot, graph):
-        for node in graph.nodes():
-            if graph.nodes[node].get('subnet', 'UNKNOWN') == 'UNKNOWN':
-                dot.node(node, **self._get_node_attrs(graph, node))
-
-    def _get_node_attrs(self, graph, node):
-        data = graph.nodes[node]
-        role = data.get('role', 'UNKNOWN')
-        ports = data.get('ports', [])
+            lines.append(f'\tsubgraph cluster_{i} {{')
+            lines.append('\t\tgraph ' + _format_attrs({
+                'label': f'Subnet: {subnet}', 'style': 'filled', 'color': 'lightgrey',
+                'fontname': 'Arial', 'fontsize': '10'
+            }))
+            for node, attrs in nodes:
+                node_attrs = self._get_node_attrs(node, attrs, profile['show_ports'])
+                lines.append(f'\t\t{_quote(node)} {_format_attrs(node_attrs)}')
+            lines.append('\t}')
+
+        return subnets, used_roles
+
+    def _add_unknown_subnet_nodes(self, lines, unknown_nodes, profile):
+        show_ports = profile['show_ports']
+        lines.extend(
+            f'\t{_quote(node)} {_format_attrs(self._get_node_attrs(node, attrs, show_ports))}'
+            for node, attrs in unknown_nodes
+        )
+
+    def _get_node_attrs(self, node, attrs, show_ports=True):
+        role = attrs.get('role', 'UNKNOWN')
+        ports = attrs.get('ports', [])
 
         label_lines = [node, role]
-        if ports:
-            visible = ports[:5]
+        if show_ports and ports:
+            # Solo le prime porte in ordine: non serve ordinare l'intera lista
+            visible = heapq.nsmallest(5, ports)
             label_lines += [f"{port} ({proto})" for port, _, proto in visible]
             if len(ports) > 5:
                 label_lines.append(f"+{len(ports) - 5} altre")
@@ -86,60 +206,168 @@ class GraphvizGenerator(OutputGenerator):
             'fontcolor': 'black'
         }
 
-    def _add_edges(self, dot, graph):
-        for src, dst, data in graph.edges(data=True):
-            weight = data.get('weight', 1)
-            protocols = data.get('protocols', [])
-            penwidth = str(0.5 + min(5, weight / 10))
-
-            label = ", ".join(protocols[:3])
-            if len(protocols) > 3:
-                label += f", +{len(protocols) - 3}"
-            if weight > 1:
-                label += f" ({weight} conn.)"
-
-            dot.edge(src, dst, label=label, penwidth=penwidth)
-
-    def _add_legend(self, dot, graph):
-        used_roles = {graph.nodes[n].get('role', 'UNKNOWN') for n in graph.nodes()}
-
-        with dot.subgraph(name='cluster_legend') as legend:
-            legend.attr(label='Legenda', rankdir='LR', style='filled', color='white')
-            for i, role in enumerate(sorted(used_roles)):
-                legend.node(f'legend_{i}',
-                            label=role,
-                            shape=ROLE_SHAPES.get(role, 'ellipse'),
-                            style='filled',
-                            fillcolor=ROLE_COLORS.get(role, 'lightgray'),
-                            fontcolor='black')
-
-    def _render_output(self, dot, output_path):
-        basename = os.path.splitext(output_path)[0]
+    def _add_edges(self, lines, edges, profile):
+        show_labels = profile['show_edge_labels']
+        # Righe DOT preformattate aggiunte al corpo con un'unica operazione
+        lines.extend(
+            f'\t{_quote(src)} -> {_quote(dst)} '
+            f'{_edge_attrs(tuple(sorted(data.get("protocols", ()))), data.get("weight", 1), show_labels)}'
+            for src, dst, data in edges
+        )
+
+    def _add_legend(self, lines, used_roles):
+        lines.append('\tsubgraph cluster_legend {')
+        lines.append('\t\tgraph ' + _format_attrs({
+            'label': 'Legenda', 'rankdir': 'LR', 'style': 'filled', 'color': 'white'
+        }))
+        for i, role in enumerate(sorted(used_roles)):
+            lines.append(f'\t\tlegend_{i} ' + _format_attrs({
+                'label': role,
+                'shape': ROLE_SHAPES.get(role, 'ellipse'),
+                'style': 'filled',
+                'fillcolor': ROLE_COLORS.get(role, 'lightgray'),
+                'fontcolor': 'black'
+            }))
+        lines.append('\t}')
+
+    def _render_output(self, dot_source, output_path, graph):
+        basename, ext = os.path.splitext(output_path)
+        ext = ext.lower()
+        # Se il percorso indica un formato noto si renderizza solo quello
+        if ext in ('.pdf', '.png'):
+            outputs = [(ext[1:], output_path)]
+        else:
+            outputs = [('pdf', basename + '.pdf'), ('png', basename + '_png.png')]
+
+        source = dot_source.encode('utf-8')
+        cache_paths = self._get_cache_paths(source, outputs)
+        if cache_paths and all(os.path.exists(cached) for cached in cache_paths):
+            try:
+                for (fmt, path), cached in zip(outputs, cache_paths):
+                    shutil.copyfile(cached, path)
+                    # L'mtime aggiornato tiene in cache i grafi usati di recente
+                    os.utime(cached)
+                    logger.info(f"Grafo {fmt.upper()} recuperato dalla cache in {path}")
+                return output_path
+            except OSError as e:
+                # In caso di errore si procede con il rendering normale
+                logger.warning(f"Impossibile recuperare il grafo dalla cache: {e}")
+
         try:
-            dot.render(basename, cleanup=True)
-            logger.info(f"Grafo PDF salvato in {basename}.pdf")
+            # Un solo processo dot legge il sorgente da stdin e produce tutti i formati
+            # riusando lo stesso layout (ogni -o si associa al -T corrispondente)
+            cmd = ['dot'] + [f'-T{fmt}' for fmt, _ in outputs] + [f'-o{path}' for _, path in outputs]
+            subprocess.run(cmd, input=source, check=True, capture_output=True)
 
-            dot.format = 'png'
-            png_path = dot.render(basename + "_png", cleanup=True)
-            logger.info(f"Grafo PNG salvato in {png_path}")
+            for fmt, path in outputs:
+                if fmt == 'png':
+                    self._quantize_png(path)
+                logger.info(f"Grafo {fmt.upper()} salvato in {path}")
 
-            if output_path.lower().endswith('.png'):
-                os.rename(png_path, output_path)
-                logger.info(f"File rinominato in {output_path}")
+            if cache_paths:
+                self._store_in_cache(outputs, cache_paths)
 
             return output_path
 
+        except subprocess.CalledProcessError as e:
+            # Lo stderr di dot contiene la diagnosi (errori di sintassi DOT, font, ...)
+            stderr = (e.stderr or b'').decode(errors='replace').strip()
+            logger.error(f"Errore durante la generazione con Graphviz (dot terminato con codice {e.returncode}): {stderr}")
+            return self._fallback_render(graph, output_path)
+
         except Exception as e:
             logger.error(f"Errore durante la generazione con Graphviz: {e}")
-            return self._fallback_render(dot, output_path)
+            return self._fallback_render(graph, output_path)
+
+    def _quantize_png(self, png_path):
+        """Converte il PNG in un'immagine a palette (8 bit) se Pillow è disponibile"""
+        try:
+            from PIL import Image
+        except ImportError:
+            return
+
+        try:
+            with Image.open(png_path) as image:
+                quantized = image.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+            # Codifica in memoria: il file viene sovrascritto solo se la conversione riesce
+            buf = io.BytesIO()
+            quantized.save(buf, format='PNG', optimize=True)
+            with open(png_path, 'wb') as f:
+                f.write(buf.getvalue())
+        except Exception as e:
+            # Conversione solo di ottimizzazione (modi non supportati, Pillow datati):
+            # in caso di errore il PNG prodotto da dot resta invariato
+            logger.warning(f"Impossibile convertire il PNG in formato a palette: {e}")
+
+    def _get_cache_paths(self, source, outputs):
+        """
+        Calcola i percorsi in cache dei file renderizzati a partire dal sorgente DOT
+
+        Args:
+            source (bytes): Sorgente DOT del grafo
+            outputs (list): Coppie (formato, percorso) da produrre
+
+        Returns:
+            list or None: Percorsi in cache, None se la cache è disabilitata
+        """
+        if not GRAPH_CACHE_DIR:
+            return None
+        key = hashlib.blake2b(source, digest_size=16).hexdigest()
+        return [os.path.join(GRAPH_CACHE_DIR, f"{key}.{fmt}") for fmt, _ in outputs]
+
+    def _store_in_cache(self, outputs, cache_paths):
+        """Copia i file renderizzati nella cache, senza far fallire la generazione"""
+        try:
+            os.makedirs(GRAPH_CACHE_DIR, exist_ok=True)
+            for (_, path), cached in zip(outputs, cache_paths):
+                # Copia su un file temporaneo e rinomina atomica: una richiesta concorrente
+                # non vede mai un file in cache scritto a metà
+                fd, tmp_path = tempfile.mkstemp(dir=GRAPH_CACHE_DIR, suffix='.tmp')
+                os.close(fd)
+                try:
+                    shutil.copyfile(path, tmp_path)
+                    os.replace(tmp_path, cached)
+                except OSError:
+                    os.unlink(tmp_path)
+                    raise
+            self._evict_cache()
+        except OSError as e:
+            logger.warning(f"Impossibile salvare il grafo nella cache: {e}")
+
+    def _evict_cache(self):
+        """Rimuove i file meno recenti oltre GRAPH_CACHE_MAX_FILES"""
+        entries = []
+        for entry in os.scandir(GRAPH_CACHE_DIR):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                entries.append((entry.stat().st_mtime, entry.path))
+        entries.sort(reverse=True)
+        for _, path in entries[GRAPH_CACHE_MAX_FILES:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
     def _fallback_render(self, graph, output_path):
         try:
-            pos = nx.spring_layout(graph)
-            plt.figure(figsize=(12, 8))
-            nx.draw(graph, pos, with_labels=True, node_size=300, font_size=8)
-            plt.savefig(output_path)
-            plt.close()
+            # Import differito: matplotlib serve solo nel fallback; il canvas Agg
+            # non passa da pyplot e non modifica il backend del processo
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+            # Figura e canvas Agg creati direttamente, senza lo stato globale di pyplot
+            # Layout a costo limitato: iterazioni ridotte e seed fisso
+            pos = nx.spring_layout(graph, iterations=20, seed=0)
+            fig = Figure(figsize=(12, 8))
+            FigureCanvasAgg(fig)
+            ax = fig.add_subplot(111)
+            nx.draw(graph, pos, ax=ax, with_labels=True, node_size=300, font_size=8)
+
+            # Rendering in memoria e una sola scrittura su disco
+            fmt = os.path.splitext(output_path)[1].lower().lstrip('.') or 'png'
+            buf = io.BytesIO()
+            fig.savefig(buf, format=fmt)
+            with open(output_path, 'wb') as f:
+                f.write(buf.getvalue())
             logger.info(f"Grafo salvato come PNG con fallback: {output_path}")
             return output_path
         except Exception as e:
@@ -35,7 +35,4 @@ class NetworkParser(ABC):
         Returns:
             str or None: Nome del servizio se trovato, None altrimenti
         """
-        if port in COMMON_PORTS:
-            service = COMMON_PORTS[port]
-            return service
-        return None
\ No newline at end of file
+        return COMMON_PORTS.get(port)
\ No newline at end of file
@@ -3,69 +3,292 @@
 PCAP Parser - parser specifico per i file PCAP
 """
 
-from scapy.all import rdpcap, IP, TCP, UDP
-from config import logger, COMMON_PORTS
+import os
+import mmap
+import socket
+import struct
+from collections import Counter
+import multiprocessing
+import dpkt
+from config import (logger, PCAP_PARALLEL_MIN_SIZE, PCAP_PARALLEL_CHUNK_MIN,
+                    PCAP_PARALLEL_MAX_WORKERS)
 from parsers.base_parser import NetworkParser
 
+# LINKTYPE_RAW: valore scritto nei file pcap per l'IP grezzo (DLT_RAW vale 12 o 14
+# a seconda della piattaforma, ma non compare nei file)
+LINKTYPE_RAW = 101
+
+CISCO_HDLC_HEADER = struct.Struct('>2xH')
+
+def _decode_ieee80211(buf):
+    """Decodifica un frame 802.11 di dati fino all'incapsulamento LLC/SNAP"""
+    return _ieee80211_payload(dpkt.ieee80211.IEEE80211(buf))
+
+def _decode_radiotap(buf):
+    """Decodifica un frame 802.11 preceduto dall'header radiotap"""
+    frame = dpkt.radiotap.Radiotap(buf).data
+    if type(frame) is not dpkt.ieee80211.IEEE80211:
+        raise dpkt.UnpackError("frame 802.11 non decodificabile")
+    return _ieee80211_payload(frame)
+
+def _ieee80211_payload(frame):
+    """Restituisce l'header LLC di un frame 802.11 di dati, il cui payload è il pacchetto IP"""
+    if frame.type != dpkt.ieee80211.DATA_TYPE:
+        raise dpkt.UnpackError("frame 802.11 non di dati")
+    return dpkt.llc.LLC(frame.data)
+
+def _decode_cisco_hdlc(buf):
+    """Decodifica un frame Cisco HDLC (indirizzo, controllo, protocollo)"""
+    if len(buf) < CISCO_HDLC_HEADER.size:
+        raise dpkt.NeedData("frame Cisco HDLC troncato")
+    if CISCO_HDLC_HEADER.unpack_from(buf)[0] != dpkt.ethernet.ETH_TYPE_IP:
+        raise dpkt.UnpackError("frame Cisco HDLC non IPv4")
+    return dpkt.ip.IP(buf[CISCO_HDLC_HEADER.size:])
+
+# Decoder del livello di collegamento per i datalink type supportati; ogni decoder
+# restituisce il pacchetto IP o un header il cui attributo data è il pacchetto IP
+LINK_DECODERS = {
+    dpkt.pcap.DLT_EN10MB: dpkt.ethernet.Ethernet,
+    dpkt.pcap.DLT_LINUX_SLL: dpkt.sll.SLL,
+    dpkt.pcap.DLT_LINUX_SLL2: dpkt.sll2.SLL2,
+    dpkt.pcap.DLT_NULL: dpkt.loopback.Loopback,
+    dpkt.pcap.DLT_LOOP: dpkt.loopback.Loopback,
+    dpkt.pcap.DLT_RAW: dpkt.ip.IP,
+    LINKTYPE_RAW: dpkt.ip.IP,
+    dpkt.pcap.DLT_IPV4: dpkt.ip.IP,
+    dpkt.pcap.DLT_PPP: dpkt.ppp.PPP,
+    dpkt.pcap.DLT_PPP_SERIAL: dpkt.ppp.PPP,
+    dpkt.pcap.DLT_C_HDLC: _decode_cisco_hdlc,
+    dpkt.pcap.DLT_IEEE802_11: _decode_ieee80211,
+    dpkt.pcap.DLT_IEEE802_11_RADIO: _decode_radiotap,
+}
+
+# Magic number dei file pcap classici -> ordine dei byte degli header
+PCAP_BYTE_ORDERS = {
+    b'\xd4\xc3\xb2\xa1': '<',
+    b'\x4d\x3c\xb2\xa1': '<',
+    b'\xa1\xb2\xc3\xd4': '>',
+    b'\xa1\xb2\x3c\x4d': '>',
+}
+# Dispatch per tipo del livello di trasporto decodificato da dpkt
+TRANSPORT_PROTOCOLS = {
+    dpkt.tcp.TCP: "TCP",
+    dpkt.udp.UDP: "UDP",
+}
+
+PCAP_GLOBAL_HEADER_LEN = 24
+PCAP_RECORD_HEADER_LEN = 16
+
+def _aggregate_packets(packets, decode):
+    """
+    Decodifica i pacchetti e ne aggrega host, flussi, porte e protocolli
+
+    Args:
+        packets (iterable): Coppie (timestamp, buffer) lette dal file
+        decode (callable): Decoder del livello di collegamento
+
+    Returns:
+        tuple: (numero di pacchetti, host, flussi, porte, protocolli)
+    """
+    packet_count = 0
+    hosts = set()
+    flows = Counter()
+    ports = set()
+    protos = Counter()
+
+    # Metodi e classi legati a nomi locali per evitare LOAD_ATTR nel ciclo
+    add_host = hosts.add
+    add_port = ports.add
+    ip_class = dpkt.ip.IP
+    transport_protocols = TRANSPORT_PROTOCOLS
+
+    for _, buf in packets:
+        packet_count += 1
+        try:
+            frame = decode(buf)
+        except dpkt.UnpackError:
+            continue
+
+        ip = frame if type(frame) is ip_class else frame.data
+        if type(ip) is not ip_class:
+            continue
+
+        src_ip = socket.inet_ntoa(ip.src)
+        dst_ip = socket.inet_ntoa(ip.dst)
+
+        # Salva gli host e le connessioni
+        add_host(src_ip)
+        add_host(dst_ip)
+        flows[(src_ip, dst_ip)] += 1
+
+        # Analisi del protocollo
+        transport = ip.data
+        proto = transport_protocols.get(type(transport))
+        if proto is not None:
+            sport = transport.sport
+            dport = transport.dport
+        else:
+            proto = "OTHER"
+            sport = None
+            dport = None
+
+        protos[proto] += 1
+
+        # Registra le porte utilizzate dagli host
+        if sport:
+            add_port((src_ip, sport, "src", proto))
+        if dport:
+            add_port((dst_ip, dport, "dst", proto))
+
+    return packet_count, hosts, flows, ports, protos
+
+def _iter_until_truncated(packets):
+    """Itera sui pacchetti del reader fermandosi sull'ultimo record completo"""
+    try:
+        yield from packets
+    except (dpkt.NeedData, dpkt.UnpackError) as e:
+        # Capture troncata (es. tcpdump interrotto): si tengono i pacchetti già letti
+        logger.warning(f"Capture troncata, analisi fermata all'ultimo record completo: {e}")
+
+def _iter_records(data, byte_order, start=0, end=None):
+    """Itera sui record (timestamp, buffer) contenuti nell'intervallo [start, end) di un file pcap"""
+    record_header = struct.Struct(byte_order + 'I4xI4x')
+    offset = start
+    if end is None:
+        end = len(data)
+    while offset + PCAP_RECORD_HEADER_LEN <= end:
+        ts_sec, incl_len = record_header.unpack_from(data, offset)
+        offset += PCAP_RECORD_HEADER_LEN
+        yield ts_sec, data[offset:offset + incl_len]
+        offset += incl_len
+
+def _split_records(file_path, byte_order, chunks):
+    """
+    Divide un file pcap in intervalli di byte allineati all'inizio dei record
+
+    Args:
+        file_path (str): Percorso del file PCAP
+        byte_order (str): Ordine dei byte degli header ('<' o '>')
+        chunks (int): Numero di intervalli desiderato
+
+    Returns:
+        list: Coppie (inizio, fine) di offset nel file
+    """
+    size = os.path.getsize(file_path)
+    target = max(1, (size - PCAP_GLOBAL_HEADER_LEN) // chunks)
+    incl_len_field = struct.Struct(byte_order + '8xI4x')
+
+    bounds = [PCAP_GLOBAL_HEADER_LEN]
+    offset = PCAP_GLOBAL_HEADER_LEN
+    next_bound = offset + target
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        while offset + PCAP_RECORD_HEADER_LEN <= size:
+            if offset >= next_bound:
+                bounds.append(offset)
+                next_bound = offset + target
+            offset += PCAP_RECORD_HEADER_LEN + incl_len_field.unpack_from(data, offset)[0]
+    bounds.append(min(offset, size))
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _available_cpus():
+    """Numero di CPU utilizzabili dal processo, tenendo conto della maschera di affinità"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def _parse_chunk(task):
+    """Analizza un intervallo di record pcap in un processo separato"""
+    file_path, start, end, byte_order, datalink = task
+    # Il file è mappato in memoria: si copiano solo i singoli pacchetti, non l'intero intervallo
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return _aggregate_packets(_iter_records(data, byte_order, start, end),
+                                  LINK_DECODERS[datalink])
+
 class PCAPParser(NetworkParser):
     """Parser per i file PCAP"""
-    
+
     def parse(self, file_path, network_data):
         """
         Analizza un file PCAP e popola l'oggetto network_data
-        
+
         Args:
             file_path (str): Percorso del file PCAP da analizzare
             network_data (NetworkData): Oggetto che contiene i dati di rete
-            
+
         Returns:
             bool: True se l'analisi è riuscita, False altrimenti
         """
         logger.info(f"Analisi del file PCAP: {file_path}")
-        
+
         try:
-            packets = rdpcap(file_path)
-            for packet in packets:
-                if IP in packet:
-                    src_ip = packet[IP].src
-                    dst_ip = packet[IP].dst
-                    
-                    # Salva gli host
-                    network_data.add_host(src_ip)
-                    network_data.add_host(dst_ip)
-                    
-                    # Salva le connessioni
-                    network_data.add_connection(src_ip, dst_ip)
-                    
-                    # Analisi del protocollo
-                    if TCP in packet:
-                        proto = "TCP"
-                        sport = packet[TCP].sport
-                        dport = packet[TCP].dport
-                    elif UDP in packet:
-                        proto = "UDP"
-                        sport = packet[UDP].sport
-                        dport = packet[UDP].dport
-                    else:
-                        proto = "OTHER"
-                        sport = None
-                        dport = None
-                    
-                    network_data.add_protocol(proto)
-                    
-                    # Registra le porte utilizzate dagli host
-                    if sport:
-                        network_data.add_port(src_ip, sport, "src", proto)
-                    if dport:
-                        network_data.add_port(dst_ip, dport, "dst", proto)
-                        
-                        # Mapping dei servizi basati sulle porte di destinazione
-                        self.map_service(dst_ip, dport, network_data)
-            
-            logger.info(f"Analizzati {len(packets)} pacchetti dal file PCAP")
-            
+            with open(file_path, 'rb') as f:
+                header = f.read(PCAP_GLOBAL_HEADER_LEN)
+
+            # I file pcap classici di grandi dimensioni vengono divisi tra più processi;
+            # pcapng e file piccoli seguono la lettura sequenziale
+            byte_order = PCAP_BYTE_ORDERS.get(header[:4])
+            size = os.path.getsize(file_path)
+            workers = min(_available_cpus(), PCAP_PARALLEL_MAX_WORKERS,
+                          size // PCAP_PARALLEL_CHUNK_MIN)
+            if (byte_order and workers > 1 and len(header) == PCAP_GLOBAL_HEADER_LEN
+                    and size >= PCAP_PARALLEL_MIN_SIZE):
+                result = self._parse_parallel(file_path, header, byte_order, workers)
+            else:
+                result = self._parse_sequential(file_path)
+
+            if result is None:
+                return False
+            packet_count, hosts, flows, ports, protos = result
+
+            # NetworkData viene aggiornato una sola volta per ogni flusso/porta distinti
+            network_data.add_hosts(hosts)
+            network_data.add_connections(flows)
+            network_data.add_ports(ports)
+            network_data.add_protocols(protos)
+
+            logger.info(f"Analizzati {packet_count} pacchetti dal file PCAP")
+
         except Exception as e:
             logger.error(f"Errore nell'analisi del file PCAP: {e}")
             return False
-        
-        return True
\ No newline at end of file
+
+        return True
+
+    def _parse_sequential(self, file_path):
+        """Analizza il file in streaming nel processo corrente"""
+        with open(file_path, 'rb') as f:
+            reader = dpkt.pcap.UniversalReader(f)
+            decode = LINK_DECODERS.get(reader.datalink())
+            if decode is None:
+                logger.error(f"Tipo di datalink non supportato: {reader.datalink()}")
+                return None
+
+            return _aggregate_packets(_iter_until_truncated(reader), decode)
+
+    def _parse_parallel(self, file_path, header, byte_order, workers):
+        """Analizza il file dividendo i record tra più processi e unendo i risultati"""
+        datalink = struct.unpack_from(byte_order + 'I', header, 20)[0]
+        if datalink not in LINK_DECODERS:
+            logger.error(f"Tipo di datalink non supportato: {datalink}")
+            return None
+
+        tasks = [(file_path, start, end, byte_order, datalink)
+                 for start, end in _split_records(file_path, byte_order, workers)]
+        logger.info(f"Analisi parallela del file PCAP su {len(tasks)} processi")
+
+        # parse() può girare in un thread del server Flask: i processi vengono avviati
+        # con spawn, perché il fork di un processo multi-thread non è sicuro
+        with multiprocessing.get_context('spawn').Pool(min(workers, len(tasks))) as pool:
+            results = pool.map(_parse_chunk, tasks)
+
+        packet_count, hosts, flows, ports, protos = results[0]
+        for chunk_count, chunk_hosts, chunk_flows, chunk_ports, chunk_protos in results[1:]:
+            packet_count += chunk_count
+            hosts |= chunk_hosts
+            flows += chunk_flows
+            ports |= chunk_ports
+            protos += chunk_protos
+
+        return packet_count, hosts, flows, ports, protos
\ No newline at end of file
@@ -12,10 +12,9 @@ setup(
     author="Network Team",
     packages=find_packages(),
     install_requires=[
-        "scapy",
+        "dpkt",
         "pandas",
         "numpy",
-        "graphviz",
         "networkx",
         "matplotlib",
     ],